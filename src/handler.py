@@ -1,12 +1,21 @@
+import asyncio
+import base64
+import functools
+import hashlib
 import json
 import os
-import shutil
+import tarfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import google_crc32c
 import runpod
-import yaml
+from google.api_core.exceptions import Forbidden
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage  # GCS 上传
+from google.cloud.storage import transfer_manager
 from google.oauth2.service_account import Credentials
 from huggingface_hub._login import login
+from requests.adapters import HTTPAdapter
 
 from train import train
 
@@ -14,50 +23,330 @@ BASE_VOLUME = os.environ.get("BASE_VOLUME", "/runpod-volume")
 if not os.path.exists(BASE_VOLUME):
     os.makedirs(BASE_VOLUME)
 
-logger = runpod.RunPodLogger()
-
-
-# GCS 上传函数
-async def upload_to_gcs(local_dir: str, bucket_name: str, project_id: str, credentials_json: str, gcs_path: str):
-    key_info = json.loads(credentials_json)
-
-    # 创建 credentials
-    credentials = Credentials.from_service_account_info(key_info)
+# 中间 checkpoint 目录（checkpoint-<step>）不上传
+CHECKPOINT_PREFIX = "checkpoint-"
+GCS_UPLOAD_CONCURRENCY = int(os.environ.get("GCS_UPLOAD_CONCURRENCY", "16"))
+# 超过阈值的大文件（模型权重分片）走 XML multipart 分块并发上传
+GCS_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+GCS_MULTIPART_CHUNK_SIZE = 32 * 1024 * 1024
+GCS_MULTIPART_WORKERS = 8
+# 可选：把非权重的小文本文件（config、tokenizer、日志等）打包成一个 tar.zst 上传，减少请求数
+GCS_PACK_SMALL_FILES = os.environ.get("GCS_PACK_SMALL_FILES", "0") == "1"
+GCS_ARCHIVE_NAME = "artifacts.tar.zst"
+# 权重文件始终单独上传，保证可以直接从 GCS 加载
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth")
+CLEANUP_CONCURRENCY = 32
+# 训练日志批量输出：每 LOG_FLUSH_SIZE 条或每 LOG_FLUSH_INTERVAL 秒刷新一次
+LOG_FLUSH_SIZE = 50
+LOG_FLUSH_INTERVAL = 1.0
+LOG_QUEUE_SIZE = 1024
+# requests 默认连接池只有 10 个连接，调大以匹配峰值并发连接数：
+# 每个外层 worker 最多 GCS_MULTIPART_WORKERS 个分块连接，另加 upload_many 的 GCS_UPLOAD_CONCURRENCY 个
+GCS_HTTP_POOL_SIZE = int(
+    os.environ.get("GCS_HTTP_POOL_SIZE", str(GCS_UPLOAD_CONCURRENCY * (GCS_MULTIPART_WORKERS + 1)))
+)
 
-    # 创建 client，手动传入 credentials）
-    client = storage.Client(credentials=credentials, project=project_id)
+logger = runpod.RunPodLogger()
 
+# 上一次 HF login 的 token 哈希，warm worker 上同一个 token 不重复 login
+_hf_login_hash = None
+
+
+def _iter_files(local_dir: str, rel_dir: str = ""):
+    """
+    Recursively yield (local_path, rel_path) for files under local_dir,
+    pruning checkpoint-* directories without descending into them.
+    """
+    # 相对路径前缀每个目录只算一次，文件只做字符串拼接
+    prefix = f"{rel_dir}/" if rel_dir else ""
+    with os.scandir(local_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                # 过滤 checkpoint- 开头的文件夹（整棵子树跳过）
+                if entry.name.startswith(CHECKPOINT_PREFIX):
+                    continue
+                yield from _iter_files(entry.path, prefix + entry.name)
+            elif entry.is_file():
+                # 指向目录的符号链接不是文件，跳过（与 os.walk 不跟随链接时一致）
+                yield entry.path, prefix + entry.name
+
+
+@functools.lru_cache(maxsize=8)
+def _get_credentials(sa_hash: str, credentials_json: str):
+    # 手动创建的 AuthorizedSession 不会被 storage.Client 补 scope，这里必须显式指定
+    return Credentials.from_service_account_info(json.loads(credentials_json), scopes=storage.Client.SCOPE)
+
+
+# 按 (project_id, sa_hash) 缓存 GCS client，warm worker 复用凭证和 HTTP 连接池；key 轮换后旧 client 按 LRU 淘汰
+@functools.lru_cache(maxsize=8)
+def _build_gcs_client(project_id: str, sa_hash: str, credentials_json: str):
+    credentials = _get_credentials(sa_hash, credentials_json)
+    session = AuthorizedSession(credentials)
+    # 所有上传请求都发往 storage.googleapis.com，一个 host 连接池即可，keep-alive 连接在线程间复用
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GCS_HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    # 创建 client，手动传入 credentials 和共享的 session
+    return storage.Client(credentials=credentials, project=project_id, _http=session)
+
+
+def _get_gcs_client(project_id: str, credentials_json: str):
+    sa_hash = hashlib.sha256(credentials_json.encode()).hexdigest()
+    return _build_gcs_client(project_id, sa_hash, credentials_json)
+
+
+def _crc32c(local_path: str) -> str:
+    # 与 GCS blob.crc32c 相同的格式：大端 4 字节 base64
+    checksum = google_crc32c.Checksum()
+    with open(local_path, "rb") as file:
+        for chunk in iter(lambda: file.read(GCS_MULTIPART_CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode()
+
+
+def _upload_file(bucket, local_path: str, blob_name: str, existing=None) -> bool:
+    """
+    Upload a single file, skipping it if an identical blob already exists.
+    :return: True if the file was uploaded, False if it was skipped
+    """
+    size = os.path.getsize(local_path)
+    # 断点续传：远端已有同样大小和 crc32c 的对象则跳过
+    if existing is not None and existing.size == size and existing.crc32c == _crc32c(local_path):
+        return False
+
+    blob = bucket.blob(blob_name)
+    if size > GCS_MULTIPART_THRESHOLD:
+        transfer_manager.upload_chunks_concurrently(
+            local_path,
+            blob,
+            chunk_size=GCS_MULTIPART_CHUNK_SIZE,
+            max_workers=GCS_MULTIPART_WORKERS,
+            worker_type=transfer_manager.THREAD,
+        )
+    else:
+        # 新对象用 if_generation_match=0，避免重复任务并发写同一对象时互相覆盖
+        blob.upload_from_filename(local_path, if_generation_match=existing.generation if existing else 0)
+    return True
+
+
+def _upload_many(bucket, files: list):
+    """
+    Upload new small files with transfer_manager.upload_many.
+    :return: (uploaded, skipped) counts; files that appeared remotely in the meantime count as skipped
+    """
+    results = transfer_manager.upload_many(
+        [(local_path, bucket.blob(blob_name)) for local_path, blob_name in files],
+        skip_if_exists=True,
+        raise_exception=True,
+        worker_type=transfer_manager.THREAD,
+        max_workers=GCS_UPLOAD_CONCURRENCY,
+    )
+    skipped = sum(1 for result in results if isinstance(result, Exception))
+    return len(results) - skipped, skipped
+
+
+def _upload_archive(bucket, files: list, blob_name: str) -> bool:
+    """
+    Stream the given (local_path, rel_path) files into a single zstd-compressed tar blob.
+    """
+    import zstandard
+
+    cctx = zstandard.ZstdCompressor(level=3, threads=-1)
+    with bucket.blob(blob_name).open("wb", ignore_flush=True) as blob_writer:
+        with cctx.stream_writer(blob_writer, closefd=False) as compressor, tarfile.open(
+            fileobj=compressor, mode="w|"
+        ) as tar:
+            for local_path, rel_path in files:
+                tar.add(local_path, arcname=rel_path)
+    return True
+
+
+def _list_existing_blobs(bucket_name: str, project_id: str, credentials_json: str, gcs_path: str):
+    # 一次 list 拿到已上传的对象，重试时只需补传缺失/变化的文件
+    bucket = _get_gcs_client(project_id, credentials_json).bucket(bucket_name)
+    try:
+        return {blob.name: blob for blob in bucket.list_blobs(prefix=f"{gcs_path}/")}
+    except Forbidden as e:
+        # 只有上传权限（roles/storage.objectCreator）的服务账号无法 list：按全新路径上传，
+        # 新对象仍有 if_generation_match=0 保护
+        logger.warn(f"Cannot list gs://{bucket_name}/{gcs_path}, uploading all files: {e}")
+        return {}
+
+
+def _upload_dir(
+    local_dir: str, bucket_name: str, project_id: str, credentials_json: str, gcs_path: str, existing_blobs=None
+):
+    client = _get_gcs_client(project_id, credentials_json)
     bucket = client.bucket(bucket_name)
+    if existing_blobs is None:
+        existing_blobs = _list_existing_blobs(bucket_name, project_id, credentials_json, gcs_path)
+
+    # 多线程并发上传（文件间并发；大文件内部再分块并发），共享同一个 client（client._http 连接池复用）
+    # 远端不存在的小文件交给 transfer_manager.upload_many（skip_if_exists 即 if_generation_match=0）；
+    # 大文件和远端已存在（需比较 crc32c）的文件走 _upload_file
     uploaded_files = 0
-    for root, _, files in os.walk(local_dir):
-        for file in files:
-            local_path = os.path.join(root, file)
-            rel_path = os.path.relpath(local_path, local_dir)
-            # 过滤包含checkpoint-的文件夹
-            if "checkpoint-" in rel_path:
+    skipped_files = 0
+    archive_files = []
+    new_small_files = []
+    with ThreadPoolExecutor(max_workers=GCS_UPLOAD_CONCURRENCY) as executor:
+        futures = []
+        for local_path, rel_path in _iter_files(local_dir):
+            if GCS_PACK_SMALL_FILES and not rel_path.endswith(WEIGHT_SUFFIXES):
+                archive_files.append((local_path, rel_path))
                 continue
-            blob = bucket.blob(f"{gcs_path}/{rel_path}")
-            blob.upload_from_filename(local_path)
-            uploaded_files += 1
-    logger.info(f"Uploaded {uploaded_files} files to gs://{bucket_name}/{gcs_path}")
+            blob_name = f"{gcs_path}/{rel_path}"
+            existing = existing_blobs.get(blob_name)
+            if existing is None and os.path.getsize(local_path) <= GCS_MULTIPART_THRESHOLD:
+                new_small_files.append((local_path, blob_name))
+                continue
+            futures.append(executor.submit(_upload_file, bucket, local_path, blob_name, existing))
+        if archive_files:
+            futures.append(
+                executor.submit(_upload_archive, bucket, archive_files, f"{gcs_path}/{GCS_ARCHIVE_NAME}")
+            )
+        many_future = executor.submit(_upload_many, bucket, new_small_files) if new_small_files else None
+        for future in as_completed(futures):
+            if future.result():
+                uploaded_files += 1
+            else:
+                skipped_files += 1
+        if many_future is not None:
+            uploaded, skipped = many_future.result()
+            uploaded_files += uploaded
+            skipped_files += skipped
+    return uploaded_files, skipped_files
+
+
+async def prepare_gcs_upload(bucket_name: str, project_id: str, credentials_json: str, gcs_path: str):
+    """
+    Build the GCS client (credentials, OAuth token, connections) and list the blobs already under gcs_path.
+    Meant to run concurrently with training so the upload can start transferring as soon as training ends.
+    :return: Existing blobs keyed by name, to pass to upload_to_gcs
+    """
+    return await asyncio.to_thread(_list_existing_blobs, bucket_name, project_id, credentials_json, gcs_path)
+
+
+# GCS 上传函数
+async def upload_to_gcs(
+    local_dir: str, bucket_name: str, project_id: str, credentials_json: str, gcs_path: str, existing_blobs=None
+):
+    # 同步的 GCS SDK 调用放到线程里执行，避免阻塞事件循环
+    uploaded_files, skipped_files = await asyncio.to_thread(
+        _upload_dir, local_dir, bucket_name, project_id, credentials_json, gcs_path, existing_blobs
+    )
+    logger.info(
+        f"Uploaded {uploaded_files} files to gs://{bucket_name}/{gcs_path} ({skipped_files} already up to date)"
+    )
+
+
+def _rmtree_parallel(path: str):
+    """
+    Remove a directory tree, unlinking files concurrently and then removing directories bottom-up.
+    """
+    dirs = []
+    files = []
+    for root, dirnames, filenames in os.walk(path):
+        dirs.append(root)
+        files.extend(os.path.join(root, name) for name in filenames)
+        # 指向目录的符号链接不会被 os.walk 进入，当作文件删除
+        files.extend(os.path.join(root, name) for name in dirnames if os.path.islink(os.path.join(root, name)))
+    with ThreadPoolExecutor(max_workers=CLEANUP_CONCURRENCY) as executor:
+        list(executor.map(os.unlink, files))
+    for directory in reversed(dirs):
+        os.rmdir(directory)
 
 
 # 新增：清理函数（output）
-def cleanup_output(output_dir: str):
+async def cleanup_output(output_dir: str):
     if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
+        # 在线程中并发删除，不阻塞事件循环
+        await asyncio.to_thread(_rmtree_parallel, output_dir)
         logger.info(f"Cleaned local output dir: {output_dir}")
 
 
-def validate_env(logger, rp_job_id):
-    vars = ["WANDB_API_KEY", "HF_TOKEN"]
-
-    for key in vars:
-        if key not in os.environ:
-            logger.error(
-                f"Enviornment variable {key} not found. Please set it before running the script.", job_id=rp_job_id
-            )
-            raise ValueError(f"Enviornment variable {key} not found. Please set it before running the script.")
+async def _log_flusher(queue: asyncio.Queue):
+    """
+    Drain training output from the queue and log it in batches.
+    A None item marks the end of the stream.
+    """
+    loop = asyncio.get_running_loop()
+    done = False
+    while not done:
+        batch = []
+        deadline = loop.time() + LOG_FLUSH_INTERVAL
+        while len(batch) < LOG_FLUSH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                done = True
+                break
+            batch.append(str(item))
+        if batch:
+            logger.info("\n".join(batch))
+
+
+async def _put_log(queue: asyncio.Queue, flusher: asyncio.Task, item):
+    """
+    Put an item on the log queue, re-raising the flusher's error instead of blocking forever if it has died.
+    """
+    if not flusher.done():
+        try:
+            queue.put_nowait(item)
+            return
+        except asyncio.QueueFull:
+            pass
+        put = asyncio.ensure_future(queue.put(item))
+        await asyncio.wait({put, flusher}, return_when=asyncio.FIRST_COMPLETED)
+        if put.done():
+            return
+        put.cancel()
+    flusher.result()
+    raise RuntimeError("Log flusher stopped before the end of the training output")
+
+
+def hf_login(token: str):
+    global _hf_login_hash
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    if token_hash == _hf_login_hash:
+        return
+    login(token=token)
+    _hf_login_hash = token_hash
+
+
+def validate_env(env, logger, rp_job_id):
+    # 训练子进程的环境变量 -> 任务输入 input.credentials 中的字段
+    vars = {"WANDB_API_KEY": "wandb_api_key", "HF_TOKEN": "hf_token"}
+
+    for key, field in vars.items():
+        if env.get(key) is None:
+            message = f"Credential input.credentials.{field} not found. Please set it in the job input."
+            logger.error(message, request_id=rp_job_id)
+            raise ValueError(message)
+
+
+def get_gcs_config(inputs):
+    """
+    GCS config from the job input, falling back to the GCS_* environment variables of the worker.
+    :return: dict with bucket_name, project_id, credentials_json and gcs_finetuned_model_path
+    """
+    gcs_config = inputs.get("gcs_config")
+    if gcs_config:
+        return {
+            "bucket_name": gcs_config["bucket_name"],
+            "project_id": gcs_config["project_id"],
+            "credentials_json": gcs_config["credentials_json"],
+            "gcs_finetuned_model_path": gcs_config["gcs_finetuned_model_path"],
+        }
+    return {
+        "bucket_name": os.environ["GCS_BUCKET_NAME"],
+        "project_id": os.environ["GCS_PROJECT_ID"],
+        "credentials_json": os.environ["GCS_SA_KEY"],
+        "gcs_finetuned_model_path": os.environ["GCS_FINETUNED_MODEL_PATH"],
+    }
 
 
 def get_output_dir(run_id):
@@ -76,56 +365,67 @@ async def handler(job):
     output_dir = os.path.join(BASE_VOLUME, get_output_dir(run_id), user_id)
     args["output_dir"] = output_dir
 
-    # First save args to a temporary config file
-    config_path = "/workspace/test_config.yaml"
-
-    # Add run_name and job_id to args before saving
+    # Add run_name and job_id to args
     args["run_name"] = run_id
     args["runpod_job_id"] = runpod_job_id
     hub_model_id = args.get("hub_model_id")
     args["hub_model_id"] = None
 
-    yaml_data = yaml.dump(args, default_flow_style=False)
-    with open(config_path, "w") as file:
-        file.write(yaml_data)
-
-        # Handle credentials
+    # 训练前先解析 GCS 配置和上传路径：配置错误直接失败，而不是训练完才发现上传不了
+    gcs_config = get_gcs_config(inputs)
+    bucket_name = gcs_config["bucket_name"]
+    project_id = gcs_config["project_id"]
+    credentials_json = gcs_config["credentials_json"]
+    gcs_finetuned_model_path = gcs_config["gcs_finetuned_model_path"]
+    # 没有 hub_model_id 时回退到 run_id
+    model_name = (hub_model_id or run_id).split("-")[-1]
+    gcs_path = f"{gcs_finetuned_model_path}/{user_id}/{model_name}"
+    logger.info(f"Model will be uploaded to gs://{bucket_name}/{gcs_path}", request_id=runpod_job_id)
+
+    # Handle credentials: passed to the training subprocesses only, os.environ is left untouched
     credentials = inputs["credentials"]
-    os.environ["WANDB_API_KEY"] = credentials["wandb_api_key"]
-    os.environ["HF_TOKEN"] = credentials["hf_token"]
+    train_env = {
+        "WANDB_API_KEY": credentials.get("wandb_api_key"),
+        "HF_TOKEN": credentials.get("hf_token"),
+    }
+
+    validate_env(train_env, logger, runpod_job_id)
+    hf_login(train_env["HF_TOKEN"])
 
-    validate_env(logger, runpod_job_id)
-    login(token=os.environ["HF_TOKEN"])
+    # 训练期间并行准备 GCS 上传（凭证、OAuth、列出已有对象），训练结束后直接开始传输
+    upload_prep = asyncio.create_task(prepare_gcs_upload(bucket_name, project_id, credentials_json, gcs_path))
 
     logger.info("Starting Training.")
-    async for result in train(config_path):  # Pass the config path instead of args
-        logger.info(result)
+    # 有界队列：日志跟不上时对训练输出形成背压，而不是无限占用内存
+    log_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    flusher = asyncio.create_task(_log_flusher(log_queue))
+    try:
+        async for result in train(args, env=train_env):
+            await _put_log(log_queue, flusher, result)
+    except BaseException:
+        upload_prep.cancel()
+        # 准备任务可能已经失败结束（cancel 无效），取走异常，避免 "Task exception was never retrieved"
+        if upload_prep.done() and not upload_prep.cancelled():
+            upload_prep.exception()
+        raise
+    finally:
+        await _put_log(log_queue, flusher, None)
+        await flusher
     logger.info("Training Complete.")
 
-    # Cleanup
-    del os.environ["WANDB_API_KEY"]
-    del os.environ["HF_TOKEN"]
-
     # ============ 新增：训练完成后上传 GCS ============
     try:
-        gcs_config = inputs["gcs_config"]
-        bucket_name = gcs_config["bucket_name"]
-        project_id = gcs_config["project_id"]
-        credentials_json = gcs_config["credentials_json"]
-        gcs_finetuned_model_path = f"{gcs_config['gcs_finetuned_model_path']}"
-        hub_model_id = hub_model_id.split("-")[-1]
-        gcs_path = f"{gcs_finetuned_model_path}/{user_id}/{hub_model_id}"
-
         await upload_to_gcs(
             local_dir=output_dir,
             bucket_name=bucket_name,
             project_id=project_id,
             credentials_json=credentials_json,
             gcs_path=gcs_path,
+            existing_blobs=await upload_prep,
         )
 
         # 可选：上传后清理（释放 Volume 空间，如果推理用别的 endpoint）
-        cleanup_output(output_dir)
+        await cleanup_output(output_dir)
 
         # 返回 GCS 路径（你的外部服务可直接用）
         return {
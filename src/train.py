@@ -1,20 +1,51 @@
 import asyncio
+import os
+import tempfile
+from typing import Union
 
+import yaml
 
-async def train(config_path: str, gpu_id: str = "0", preprocess: bool = True):
+try:
+    from yaml import CSafeDumper as YamlDumper  # libyaml C 实现
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+
+
+async def train(config: Union[dict, str], gpu_id: str = "0", preprocess: bool = True, env: dict = None):
     """
-    Run preprocessing (if enabled) and training with the given config file
-    :param config_path: Path to the YAML config file
+    Run preprocessing (if enabled) and training with the given config
+    :param config: Config dict, or path to the YAML config file
     :param gpu_id: GPU ID to use (default: "0")
     :param preprocess: Whether to run preprocessing (default: True)
+    :param env: Extra environment variables (e.g. credentials) for the subprocesses only
 
     """
+    if isinstance(config, str):
+        async for result in _train(config, gpu_id, preprocess, env):
+            yield result
+        return
+
+    # axolotl CLI 只接受文件路径：每个任务写到独立的临时文件，并发任务不会互相覆盖
+    fd, config_path = tempfile.mkstemp(prefix="axolotl_config_", suffix=".yaml")
+    try:
+        with os.fdopen(fd, "w") as file:
+            yaml.dump(config, file, Dumper=YamlDumper, default_flow_style=False)
+        async for result in _train(config_path, gpu_id, preprocess, env):
+            yield result
+    finally:
+        os.unlink(config_path)
+
+
+async def _train(config_path: str, gpu_id: str, preprocess: bool, env: dict):
+    # 只传给子进程，不修改本进程的 os.environ，多个任务可以并发执行
+    env = {**os.environ, **(env or {})}
+
     # First check if preprocessing is needed
     if preprocess:
         # Preprocess command
         preprocess_cmd = f"CUDA_VISIBLE_DEVICES={gpu_id} axolotl preprocess {config_path}"
         process = await asyncio.create_subprocess_shell(
-            preprocess_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+            preprocess_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env
         )
 
         async for line in process.stdout:
@@ -27,7 +58,7 @@ async def train(config_path: str, gpu_id: str = "0", preprocess: bool = True):
     # Training command
     train_cmd = f"axolotl train {config_path}"
     process = await asyncio.create_subprocess_shell(
-        train_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+        train_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env
     )
 
     async for line in process.stdout: